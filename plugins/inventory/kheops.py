@@ -63,13 +63,11 @@ query_scope:
 
 class InventoryModule(BaseInventoryPlugin, Cacheable, Constructable):
     NAME = 'kheops'
+    SUFFIXES = ('kheops.yaml', 'kheops.yml')
 
     def verify_file(self, path):
-        valid = False
-        if super(InventoryModule, self).verify_file(path):
-            if path.endswith(('kheops.yaml', 'kheops.yml')):
-                valid = True
-        return valid
+        # Check the suffix first, it is much cheaper than the parent checks
+        return path.endswith(self.SUFFIXES) and super(InventoryModule, self).verify_file(path)
 
 
     def parse(self, inventory, loader, path, cache):
@@ -101,39 +99,67 @@ class InventoryModule(BaseInventoryPlugin, Cacheable, Constructable):
             ]
         self.kheops = AnsibleKheops(configs=configs, display=self.display)
 
+        # Lookup all hosts at once
+        host_objs = {}
+        hosts = {}
+        for host_name in tuple(inventory.hosts):
+            host = inventory.get_host(host_name)
+            host_objs[host_name] = host
+            hosts[host_name] = host.get_vars()
+
+        # Load cached results, if any
+        cache_key = self.get_cache_key(path)
+        user_cache_setting = self.get_option('cache')
+        host_cache = {}
+        if user_cache_setting and cache:
+            cached = self._cache.get(cache_key, {})
+            host_cache = {key: value for key, value in cached.items() if key in hosts}
+
+        try:
+            results = self.kheops.bulk_lookup(
+                hosts,
+                keys=None,
+                scope=None,
+                _templar=self.templar,
+                jinja2_native=self.jinja2_native,
+                cache=host_cache,
+            )
+        except AnsibleError as err:
+            self.display.error("Could not lookup Kheops data for inventory hosts")
+            raise err
+
+        if user_cache_setting:
+            self._cache[cache_key] = host_cache
+
         # Loop over each hosts
-        for host_name in inventory.hosts:
+        for host_name, ret in results.items():
             try:
-                self._populate_host(host_name)
+                self._populate_host(host_objs[host_name], hosts[host_name], ret)
             except Exception as err:
                 self.display.error(f"Got errors while processing Kheops lookup for host: %s, %s" % (host_name, err))
                 raise err
 
 
-    def _populate_host(self, host_name):
-
-            host = self.inventory.get_host(host_name)
+    def _populate_host(self, host, hostvars, ret):
 
-            try:
-                ret = self.kheops.super_lookup(
-                    keys=None,
-                    scope=None,
-                    _templar=self.templar,
-                    _variables=host.get_vars(),
-                    jinja2_native=self.jinja2_native,
-                )
-            except AnsibleError as err:
-                self.display.error (f"Could lookup Kheops data for host: {host_name}")
-                raise err
+            host_name = host.name
 
             # Inject variables into host
+            verbose = self.display.verbosity >= 2
             for key, value in ret.items():
-                self.display.vv (f"Define variable for {host_name}: {key}={value}")
+                if verbose:
+                    self.display.vv(f"Define variable for {host_name}: {key}={value}")
                 host.set_variable(key, value)
 
             # Call constructed inventory plugin methods
-            hostvars = self.inventory.get_host(host_name).get_vars()
-            self._set_composite_vars(self.compose, hostvars, host_name, self.strict)
-            self._add_host_to_composed_groups(self.groups, hostvars, host_name, self.strict)
-            self._add_host_to_keyed_groups(self.keyed_groups, hostvars, host_name, self.strict)
+            if not (self.compose or self.groups or self.keyed_groups):
+                return
+            if ret:
+                hostvars = host.get_vars()
+            if self.compose:
+                self._set_composite_vars(self.compose, hostvars, host_name, self.strict)
+            if self.groups:
+                self._add_host_to_composed_groups(self.groups, hostvars, host_name, self.strict)
+            if self.keyed_groups:
+                self._add_host_to_keyed_groups(self.keyed_groups, hostvars, host_name, self.strict)
 
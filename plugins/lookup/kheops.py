@@ -15,15 +15,10 @@
 
 import json
 import os
-import sys
-import requests
-import yaml
+from collections import OrderedDict
 
 
-from copy import deepcopy
-from ansible.errors import AnsibleError
 from ansible.plugins.lookup import LookupBase
-from ansible.template import generate_ansible_template_vars, AnsibleEnvironment, USE_JINJA2_NATIVE
 
 from ansible_collections.barbu_it.ansible_kheops.plugins.plugin_utils.common import DOCUMENTATION_OPTION_FRAGMENT, AnsibleKheops
 
@@ -34,9 +29,6 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
-if USE_JINJA2_NATIVE:
-    from ansible.utils.native_jinja import NativeJinjaText
-
 DOCUMENTATION = """
     lookup: kheops
     author: Robin Cordier <robin.cordier@bell.ca>
@@ -83,16 +75,37 @@ RETURN = """
 
 """
 
-from pprint import pprint
-
 # Entry point for Ansible starts here with the LookupModule class
 class LookupModule(LookupBase):
+
+    # Kheops instances reused across lookup calls, keyed by configuration.
+    # Lookup kwargs are part of the key, so only the most recent are kept.
+    _INSTANCE_CACHE = OrderedDict()
+    _INSTANCE_CACHE_SIZE = 8
+
+    def get_kheops(self, configs):
+        """
+        Return a cached AnsibleKheops instance for these configs
+        """
+        mtime = None
+        if self.config_file and os.path.isfile(self.config_file):
+            mtime = os.path.getmtime(self.config_file)
+        cache_key = (mtime, json.dumps(configs, sort_keys=True, default=str))
+
+        kheops = self._INSTANCE_CACHE.get(cache_key)
+        if kheops is None:
+            kheops = AnsibleKheops(configs=configs, display=self._display)
+            self._INSTANCE_CACHE[cache_key] = kheops
+            if len(self._INSTANCE_CACHE) > self._INSTANCE_CACHE_SIZE:
+                self._INSTANCE_CACHE.popitem(last=False)
+        else:
+            self._INSTANCE_CACHE.move_to_end(cache_key)
+        return kheops
+
     def run(self, terms, variables=None, scope=None, **kwargs):
 
         self.set_options(direct=kwargs)
 
-        process_scope = self.get_option('process_scope')
-        process_results = self.get_option('process_results')
         jinja2_native = kwargs.pop('jinja2_native', self.get_option('jinja2_native'))
 
 
@@ -106,42 +119,39 @@ class LookupModule(LookupBase):
           #    "instance_log_level": 'DEBUG',
           #    }
           ]
-        kheops = AnsibleKheops(configs=configs, display=self._display)
+        kheops = self.get_kheops(configs)
 
 
-        # Start jinja template engine
-        if USE_JINJA2_NATIVE and not jinja2_native:
-            templar = self._templar.copy_with_new_env(environment_class=AnsibleEnvironment)
+        # Start jinja template engine, only when something needs templating.
+        # Processing modes come from the merged config, so lookup kwargs and
+        # the config file are both honored.
+        use_jinja = kheops.config["process_results"] == 'jinja' or (
+            kheops.config["process_scope"] == 'jinja' and kheops.scope_has_jinja
+        )
+        if use_jinja:
+            templar = kheops.get_templar(self._templar, jinja2_native=jinja2_native)
         else:
             templar = self._templar
 
-        # Create scope
-        if process_scope == 'vars':
-            scope = kheops.get_scope_from_host_inventory(variables, scope=None)
-        elif process_scope == 'jinja':
-            scope = kheops.get_scope_from_jinja(variables, self._templar, scope=None)
-
-        # Transform dict to list for lookup/queries
+        # Lookup all terms at once, scope is resolved by super_lookup
+        lookup_kwargs = dict(
+            _variables=variables,
+            _templar=templar,
+            jinja2_native=jinja2_native,
+        )
+        if terms and all(isinstance(term, str) for term in terms):
+            names = [
+                key.key if key.remap is None else key.remap
+                for key in kheops.parse_keys(list(terms), None)
+            ]
+            if len(set(names)) == len(set(terms)):
+                result = kheops.super_lookup(keys=list(terms), **lookup_kwargs)
+                return [result.get(name) for name in names]
+
+        # Fall back on one query per term when result names collide
         ret = []
         for term in terms:
-            result = kheops.super_lookup(
-                  keys=term,
-                  scope=scope,
-                  _variables=variables,
-                  _templar=templar,
-              )
-
-            # Render data with Templar
-            #if process_results == 'jinja':
-            #    with templar.set_temporary_context(available_variables=variables):
-            #        result = templar.template(result,
-            #                    preserve_trailing_newlines=True,
-            #                    convert_data=False, escape_backslashes=False)
-
-            #    if USE_JINJA2_NATIVE and not jinja2_native:
-            #        # jinja2_native is true globally but off for the lookup, we need this text
-            #        # not to be processed by literal_eval anywhere in Ansible
-            #        result = NativeJinjaText(result)
+            result = kheops.super_lookup(keys=term, **lookup_kwargs)
 
             # Return result
             subkey = list(result.keys())[0]
@@ -1,22 +1,19 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
+import hashlib
 import logging
-from dataclasses import dataclass
-from typing import Any, Union
 from copy import deepcopy
-import yaml
+from collections.abc import Mapping
+from dataclasses import dataclass
+from functools import cached_property, lru_cache
+from types import MappingProxyType
+from typing import Optional
 
 from ansible.errors import AnsibleError, AnsibleUndefinedVariable
-from ansible.module_utils.common.text.converters import to_native
 from ansible.utils.display import Display
-from ansible.template import (
-    generate_ansible_template_vars,
-    AnsibleEnvironment,
-    USE_JINJA2_NATIVE,
-)
-
-from kheops.app import Kheops
+from ansible.template import AnsibleEnvironment, USE_JINJA2_NATIVE
 
 
 DOCUMENTATION_OPTION_FRAGMENT = """
@@ -191,24 +188,172 @@ DOCUMENTATION_OPTION_FRAGMENT = """
 """
 
 
+# Default values, keep in sync with DOCUMENTATION_OPTION_FRAGMENT
+DEFAULT_CONFIG = MappingProxyType(
+    {
+        "config": None,
+        "mode": "instance",
+        "instance_config": "site/kheops.yml",
+        "instance_namespace": "default",
+        "instance_log_level": "WARNING",
+        "instance_explain": False,
+        "namespace": "default",
+        "scope": MappingProxyType(
+            {
+                "node": "inventory_hostname",
+                "groups": "group_names",
+            }
+        ),
+        "keys": None,
+        "process_scope": "jinja",
+        "process_results": "none",
+        "jinja2_native": False,
+    }
+)
+
 KEY_NS_SEP = "/"
+_CONFIG_FILE_CACHE = {}
+_KHEOPS_CACHE = {}
+_KHEOPS_LOGGER = logging.getLogger("kheops")
+_KHEOPS_LOG_HANDLER = logging.NullHandler()
+LOOKUP_CACHE_SIZE = 4096
+TEMPLATE_MARKERS = ("{{", "{%", "{#")
+
+# Options overridable from environment, we exclude 'config'
+ENV_CONFIG_ITEMS = {
+    item: "ANSIBLE_KHEOPS_" + item.upper()
+    for item in [
+        "mode",
+        "instance_config",
+        "instance_namespace",
+        "instance_log_level",
+        "namespace",
+        "scope",
+        "keys",
+    ]
+}
 if USE_JINJA2_NATIVE:
     from ansible.utils.native_jinja import NativeJinjaText
 
 
-@dataclass
+@dataclass(frozen=True)
 class Key:
+    __slots__ = ("key", "remap", "namespace")
+
     key: str
-    remap: Union[str, type(None)]
-    namespace: Union[type(None), str]
+    remap: Optional[str]
+    namespace: Optional[str]
 
-    def show(self):
+    def __str__(self):
         ret = self.key
         if self.namespace is not None:
             ret = f"{self.namespace}{KEY_NS_SEP}{ret}"
         return ret
 
 
+def is_template(value):
+    """
+    Tell if a string may contain a jinja expression
+    """
+    return any(marker in value for marker in TEMPLATE_MARKERS)
+
+
+@lru_cache(maxsize=1024)
+def parse_key_string(item, default_namespace):
+    """
+    Parse a key string, format is: [<namespace>/]<key>[/<remap>]
+    """
+    remap = None
+    namespace = default_namespace
+
+    key, sep, rest = item.partition(KEY_NS_SEP)
+    if sep:
+        namespace = key
+        key, sep, rest = rest.partition(KEY_NS_SEP)
+        if sep:
+            remap = rest.partition(KEY_NS_SEP)[0]
+
+    return Key(key=key, remap=remap, namespace=namespace)
+
+
+def load_yaml(stream):
+    """
+    Parse yaml, with libyaml when available
+    """
+    import yaml
+
+    try:
+        from yaml import CSafeLoader as YamlLoader
+    except ImportError:
+        from yaml import SafeLoader as YamlLoader
+
+    return yaml.load(stream, Loader=YamlLoader)
+
+
+def load_config_file(path):
+    """
+    Load a yaml configuration file, parsed files are cached until they change
+    """
+    mtime = os.path.getmtime(path)
+    cached = _CONFIG_FILE_CACHE.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    # Let the yaml parser decode the file itself
+    with open(path, "rb") as data:
+        conf_data = load_yaml(data)
+    _CONFIG_FILE_CACHE[path] = (mtime, conf_data)
+    return conf_data
+
+
+def get_kheops_instance(config, namespace):
+    """
+    Return a Kheops instance, shared by all callers with the same settings
+    """
+    mtime = os.path.getmtime(config) if os.path.isfile(config) else None
+    cache_key = (config, mtime, namespace)
+    kheops = _KHEOPS_CACHE.get(cache_key)
+    if kheops is None:
+        try:
+            from kheops.app import Kheops
+        except ImportError as err:
+            raise AnsibleError(f"The kheops python library is required: {err}")
+
+        kheops = Kheops(config=config, namespace=namespace)
+        _KHEOPS_CACHE[cache_key] = kheops
+    return kheops
+
+
+def compile_scope(scope):
+    """
+    Build a function extracting a scope from host vars
+
+    Dotted values are split once here, so nested facts can be read for
+    each host without parsing the path again.
+    """
+    # Tofix should this fail silently ?
+    if not any("." in str(val) for val in scope.values()):
+        flat_items = tuple(scope.items())
+
+        def get_flat_scope(host_vars):
+            return {key: host_vars.get(val, None) for key, val in flat_items}
+
+        return get_flat_scope
+
+    items = tuple((key, tuple(str(val).split("."))) for key, val in scope.items())
+
+    def get_scope(host_vars):
+        ret = {}
+        for key, path in items:
+            value = host_vars
+            for part in path:
+                value = value.get(part, None) if isinstance(value, Mapping) else None
+            ret[key] = value
+        return ret
+
+    return get_scope
+
+
 class AnsibleKheops:
     """Main Ansible Kheops Class"""
 
@@ -223,28 +368,54 @@ class AnsibleKheops:
         if config["mode"] == "instance":
 
             # Configure logging
-            logger = logging.getLogger("kheops")
-            logger.setLevel(config["instance_log_level"])
-
-            # See for logging: https://medium.com/opsops/debugging-requests-1989797736cc
-            class ListLoggerHandler(logging.Handler):
-                def emit(self, record):
-                    msg = self.format(record)
+            log_level = config["instance_log_level"]
+            if isinstance(log_level, str):
+                log_level = logging.getLevelName(log_level.upper())
+                if not isinstance(log_level, int):
+                    raise AnsibleError(
+                        f"Invalid Kheops log level: {config['instance_log_level']}"
+                    )
+            _KHEOPS_LOGGER.setLevel(log_level)
 
-            main_logger = logging.getLogger()
-            main_logger.addHandler(ListLoggerHandler())
-            main_logger.setLevel(logging.DEBUG)
+            # Keep Kheops records away from Python's last resort stderr handler
+            if _KHEOPS_LOG_HANDLER not in _KHEOPS_LOGGER.handlers:
+                _KHEOPS_LOGGER.addHandler(_KHEOPS_LOG_HANDLER)
 
             # Start instance
-            self.kheops = Kheops(
-                config=config["instance_config"], namespace=config["instance_namespace"]
+            self.kheops = get_kheops_instance(
+                config["instance_config"], config["instance_namespace"]
             )
         elif config["mode"] == "client":
             raise AnsibleError("Kheops client mode is not implemented")
 
         self.config = config
+        self._lookup_cache = {}
+        self._templar_copy = None
+        self._scope_getter = compile_scope(config["scope"])
         self.display.v("Kheops instance has been created, with config: %s" % config['instance_config'])
 
+    @cached_property
+    def _default_namespace(self):
+        return self.config["namespace"]
+
+    @cached_property
+    def _default_scope(self):
+        return self.config["scope"]
+
+    @cached_property
+    def _default_keys(self):
+        return self.config["keys"]
+
+    @cached_property
+    def scope_has_jinja(self):
+        """
+        Tell if the configured scope needs jinja templating
+        """
+        return any(
+            not isinstance(value, str) or is_template(value)
+            for value in self._default_scope.values()
+        )
+
     def get_config(self):
         """
         Processing order:
@@ -253,11 +424,7 @@ class AnsibleKheops:
         - Overrides with other options
         """
 
-        # Extract default value from doc
-        data_doc = yaml.safe_load(DOCUMENTATION_OPTION_FRAGMENT)
-        default_config = {
-            key: value.get("default", None) for key, value in data_doc.items()
-        }
+        default_config = DEFAULT_CONFIG
 
         merged_configs = {}
         for config in self.configs:
@@ -266,15 +433,14 @@ class AnsibleKheops:
             if isinstance(config, str):
                 self.display.vv("Read Kheops file config %s" % config)
                 if os.path.isfile(config):
-                    data = open(config, "r", encoding="utf-8")
-                    conf_data = yaml.safe_load(data)
+                    conf_data = load_config_file(config)
                 else:
                     raise AnsibleError(f"Unable to find configuration file {config}")
 
             elif isinstance(config, dict):
                 self.display.vv("Read Kheops direct config %s" % config)
                 conf_data = config
-            elif isinstance(config, type(None)):
+            elif config is None:
                 continue
             else:
                 assert False, f"Bad config for: {config}"
@@ -284,50 +450,33 @@ class AnsibleKheops:
                 merged_configs.update(conf_data)
 
         # Get environment config
-        items = [
-            # We exclude 'config'
-            "mode",
-            "instance_config",
-            "instance_namespace",
-            "instance_log_level",
-            "namespace",
-            "scope",
-            "keys",
-        ]
-        env_config = {}
-        for item in items:
-            envvar = "ANSIBLE_KHEOPS_" + item.upper()
-            try:
-                env_config[item] = os.environ[envvar]
-            except KeyError:
-                pass
+        env_config = {
+            item: os.environ[envvar]
+            for item, envvar in ENV_CONFIG_ITEMS.items()
+            if envvar in os.environ
+        }
 
         # Merge results
-        combined_config = {}
-        combined_config.update(default_config)
-        combined_config.update(env_config)
-        combined_config.update(merged_configs)
+        # The default scope is shared, give each instance its own dict
+        combined_config = {
+            **default_config,
+            "scope": dict(default_config["scope"]),
+            **env_config,
+            **merged_configs,
+        }
 
         return combined_config
 
     @staticmethod
     def parse_string(item, default_namespace):
+        if isinstance(item, str):
+            return parse_key_string(item, default_namespace)
+
         key = None
         remap = key
         namespace = default_namespace
 
-        if isinstance(item, str):
-
-            parts = item.split(KEY_NS_SEP, 3)
-            if len(parts) > 0:
-                key = parts[0]
-            if len(parts) > 1:
-                namespace = parts[0]
-                key = parts[1]
-            if len(parts) > 2:
-                remap = parts[2]
-
-        elif isinstance(item, dict):
+        if isinstance(item, dict):
             key = item.get("key")
             remap = item.get("remap", key)
             namespace = item.get("namespace", namespace)
@@ -361,30 +510,57 @@ class AnsibleKheops:
         """
         Build scope from host vars
         """
-        scope = scope or self.config["scope"]
-        ret = {}
-        for key, val in scope.items():
-            # Tofix should this fail silently ?
-            ret[key] = host_vars.get(val, None)
+        if not scope or scope is self._default_scope:
+            return self._scope_getter(host_vars)
+        return compile_scope(scope)(host_vars)
 
-        return ret
+    def get_templar(self, templar, jinja2_native=False):
+        """
+        Return a templar honoring jinja2_native, the last copy is reused
+        """
+        if not USE_JINJA2_NATIVE or jinja2_native:
+            return templar
+
+        # Already a non native environment, nothing to change
+        if type(templar.environment) is AnsibleEnvironment:
+            return templar
+
+        # Rebuilding the environment is costly, keep the copy of the last
+        # templar. A single slot never pins more than one templar.
+        if self._templar_copy is None or self._templar_copy[0] is not templar:
+            self._templar_copy = (
+                templar,
+                templar.copy_with_new_env(environment_class=AnsibleEnvironment),
+            )
+        return self._templar_copy[1]
 
     def get_scope_from_jinja(self, host_vars, templar, scope=None, jinja2_native=False):
         """
         Parse in jinja a dict scope
         """
-        scope = scope or self.config["scope"]
-
-        if USE_JINJA2_NATIVE and not jinja2_native:
-            _templar = templar.copy_with_new_env(environment_class=AnsibleEnvironment)
-        else:
-            _templar = templar
+        scope = scope or self._default_scope
 
-        _vars = deepcopy(host_vars)
+        # Plain strings are returned as is by the templar, skip it for them
         ret = {}
-        with _templar.set_temporary_context(available_variables=_vars):
+        templated = []
+        for key, value in scope.items():
+            if isinstance(value, str) and not is_template(value):
+                if USE_JINJA2_NATIVE and not jinja2_native:
+                    value = NativeJinjaText(value)
+            else:
+                templated.append(key)
+            ret[key] = value
+
+        if not templated:
+            return ret
 
-            for key, value in scope.items():
+        _templar = self.get_templar(templar, jinja2_native=jinja2_native)
+
+        # Templating only reads vars, no need to copy them
+        with _templar.set_temporary_context(available_variables=host_vars):
+
+            for key in templated:
+                value = scope[key]
                 res = value
                 try:
                     res = _templar.template(
@@ -397,7 +573,8 @@ class AnsibleKheops:
                         # jinja2_native is true globally but off for the lookup, we need this text
                         # not to be processed by literal_eval anywhere in Ansible
                         res = NativeJinjaText(res)
-                    self.display.vvv(f"Transformed scope value: {value} => {res}")
+                    if self.display.verbosity >= 3:
+                        self.display.vvv(f"Transformed scope value: {value} => {res}")
                 except AnsibleUndefinedVariable as err:
                     self.display.error(f"Got templating error for string '{value}': {err}")
                     raise err
@@ -406,71 +583,150 @@ class AnsibleKheops:
 
         return ret
 
-    def lookup(self, keys, namespace=None, scope=None, explain=None):
+    def _resolve_defaults(self, keys, namespace, scope, explain):
         """
-        Start a lookup query
+        Fill unset query parameters from config
         """
-
         if explain is None:
             explain = self.config["instance_explain"]
 
-        namespace = namespace or self.config["namespace"]
-        scope = scope or self.config["scope"]
-        keys = keys or self.config["keys"]
-        keys_config = self.parse_keys(keys, namespace)
-        keys = [i.show() for i in keys_config]
-
-        self.display.v(f"Kheops keys: {keys}")
-        self.display.vv(f"Kheops scope: {scope}")
+        return (
+            keys or self._default_keys,
+            namespace or self._default_namespace,
+            scope or self._default_scope,
+            explain,
+        )
 
-        ret = self.kheops.lookup(
-            keys=keys,
-            scope=scope,
-            # trace=True,
-            explain=explain,
-            namespace_prefix=False
+    def lookup(self, keys, namespace=None, scope=None, explain=None):
+        """
+        Start a lookup query
+        """
+        return self._lookup_resolved(
+            *self._resolve_defaults(keys, namespace, scope, explain)
         )
 
-        # Remap output
-        for key in keys_config:
+    def _lookup_resolved(self, keys, namespace, scope, explain):
+        """
+        Start a lookup query, all parameters must be already resolved
+        """
+
+        # Collect query keys and remaps in a single pass
+        query_keys = []
+        remaps = {}
+        for key in self.parse_keys(keys, namespace):
+            query_keys.append(str(key))
             if key.remap is not None and key.remap != key.key:
-                ret[key.remap] = ret[key.key]
-                del ret[key.key]
+                remaps[key.key] = key.remap
+
+        if self.display.verbosity >= 1:
+            self.display.v(f"Kheops keys: {query_keys}")
+        if self.display.verbosity >= 2:
+            self.display.vv(f"Kheops scope: {scope}")
+
+        # Kheops data does not change during a run, reuse identical queries
+        cache_key = None
+        if not explain:
+            cache_key = (tuple(query_keys), json.dumps(scope, sort_keys=True, default=str))
+        ret = self._lookup_cache.get(cache_key)
+        if ret is None:
+            ret = self.kheops.lookup(
+                keys=query_keys,
+                scope=scope,
+                # trace=True,
+                explain=explain,
+                namespace_prefix=False
+            )
+            if cache_key is not None:
+                if len(self._lookup_cache) >= LOOKUP_CACHE_SIZE:
+                    self._lookup_cache.pop(next(iter(self._lookup_cache)), None)
+                self._lookup_cache[cache_key] = ret
+
+        ret = ret or {}
+        if cache_key is not None:
+            # Callers may alter the result, never hand out the cached objects
+            ret = deepcopy(ret)
+        if remaps:
+            return {remaps.get(key, key): value for key, value in ret.items()}
+        return ret
 
-        return ret or {}
+    def clear_cache(self):
+        """
+        Forget all cached Kheops results
+        """
+        self._lookup_cache.clear()
 
-    def super_lookup(
+    @cached_property
+    def _config_mtimes(self):
+        """
+        Modification times of the configuration files in use
+        """
+        paths = [self.config["instance_config"], self.config["config"]]
+        paths.extend(config for config in self.configs if isinstance(config, str))
+        return {
+            path: os.path.getmtime(path)
+            for path in paths
+            if path and os.path.isfile(path)
+        }
+
+    def get_fingerprint(self, keys, namespace, scope):
+        """
+        Return a stable hash identifying a Kheops query
+
+        Configuration file mtimes are part of it, so cached results are
+        dropped as soon as the Kheops configuration changes.
+        """
+        query = {
+            "instance_config": self.config["instance_config"],
+            "config_mtimes": self._config_mtimes,
+            "instance_namespace": self.config["instance_namespace"],
+            "keys": keys,
+            "namespace": namespace,
+            "scope": scope,
+        }
+        data = json.dumps(query, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get_scope(
         self,
-        keys,
-        namespace=None,
+        host_vars,
         scope=None,
-        kwargs=None,
         _templar=None,
-        _variables=None,
         _process_scope=None,
-        _process_results=None,
         jinja2_native=False,
     ):
         """
-        Lookup method wrapper
+        Resolve a scope against host vars, according to process_scope
         """
 
         _process_scope = _process_scope or self.config["process_scope"]
-        _process_results = _process_results or self.config["process_results"]
 
-        scope = scope or self.config["scope"]
+        scope = scope or self._default_scope
         if _process_scope == "vars":
-            scope = self.get_scope_from_host_inventory(_variables, scope=scope)
+            scope = self.get_scope_from_host_inventory(host_vars, scope=scope)
         elif _process_scope == "jinja":
             assert _templar, f"BUG: We expected a templar object here, got: {_templar}"
             scope = self.get_scope_from_jinja(
-                _variables, _templar, scope=scope, jinja2_native=jinja2_native
+                host_vars, _templar, scope=scope, jinja2_native=jinja2_native
             )
 
-        ret = self.lookup(keys, namespace=namespace, scope=scope)
+        return scope
+
+    def render_results(
+        self,
+        ret,
+        host_vars,
+        _templar=None,
+        _process_results=None,
+        jinja2_native=False,
+    ):
+        """
+        Post process lookup results, according to process_results
+        """
+
+        _process_results = _process_results or self.config["process_results"]
 
         if _process_results == "jinja":
-            with _templar.set_temporary_context(available_variables=_variables):
+            with _templar.set_temporary_context(available_variables=host_vars):
                 ret = _templar.template(
                     ret,
                     preserve_trailing_newlines=True,
@@ -481,3 +737,132 @@ class AnsibleKheops:
                 ret = NativeJinjaText(ret)
 
         return ret
+
+    def super_lookup(
+        self,
+        keys,
+        namespace=None,
+        scope=None,
+        kwargs=None,
+        _templar=None,
+        _variables=None,
+        _process_scope=None,
+        _process_results=None,
+        jinja2_native=False,
+    ):
+        """
+        Lookup method wrapper
+        """
+
+        keys, namespace, scope, explain = self._resolve_defaults(
+            keys, namespace, scope, None
+        )
+        scope = self.get_scope(
+            _variables,
+            scope=scope,
+            _templar=_templar,
+            _process_scope=_process_scope,
+            jinja2_native=jinja2_native,
+        )
+
+        ret = self._lookup_resolved(keys, namespace, scope, explain)
+
+        return self.render_results(
+            ret,
+            _variables,
+            _templar=_templar,
+            _process_results=_process_results,
+            jinja2_native=jinja2_native,
+        )
+
+    def bulk_lookup(
+        self,
+        hosts,
+        keys=None,
+        namespace=None,
+        scope=None,
+        _templar=None,
+        _process_scope=None,
+        _process_results=None,
+        jinja2_native=False,
+        cache=None,
+    ):
+        """
+        Lookup the same keys for many hosts at once
+
+        `hosts` is a dict of host names and their variables. All scopes are
+        resolved first, then queried in one pass, and the results are
+        returned as a dict keyed by host name.
+
+        When `cache` is a dict, raw results are reused for hosts whose query
+        fingerprint did not change, and fresh results are stored back into it.
+        """
+
+        keys, namespace, scope, explain = self._resolve_defaults(
+            keys, namespace, scope, None
+        )
+
+        scopes = {}
+        for host_name, host_vars in hosts.items():
+            try:
+                scopes[host_name] = self.get_scope(
+                    host_vars,
+                    scope=scope,
+                    _templar=_templar,
+                    _process_scope=_process_scope,
+                    jinja2_native=jinja2_native,
+                )
+            except AnsibleError as err:
+                self.display.error(f"Could not build Kheops scope for host: {host_name}")
+                raise err
+
+        # Reuse cached results when the query did not change, and group
+        # remaining hosts by query so each distinct scope is resolved once
+        raw = {}
+        pending = {}
+        queries = {}
+        for host_name, host_scope in scopes.items():
+            fingerprint = self.get_fingerprint(keys, namespace, host_scope)
+            cached = cache.get(host_name) if cache is not None else None
+            if cached and cached.get("fingerprint") == fingerprint:
+                raw[host_name] = cached["result"]
+            else:
+                pending[host_name] = fingerprint
+                queries.setdefault(fingerprint, host_scope)
+
+        results = {}
+        for fingerprint, host_scope in queries.items():
+            results[fingerprint] = self._lookup_resolved(
+                keys, namespace, host_scope, explain
+            )
+
+        if cache is not None:
+            for host_name, fingerprint in pending.items():
+                cache[host_name] = {
+                    "fingerprint": fingerprint,
+                    "result": results[fingerprint],
+                }
+
+        # Results are private to this call, only copy objects that would be
+        # shared: cache entries and the same result given to several hosts
+        ret = {}
+        handed_out = set()
+        for host_name, host_vars in hosts.items():
+            fingerprint = pending.get(host_name)
+            if fingerprint is None:
+                result = deepcopy(raw[host_name])
+            else:
+                result = results[fingerprint]
+                if cache is not None or fingerprint in handed_out:
+                    result = deepcopy(result)
+                handed_out.add(fingerprint)
+
+            ret[host_name] = self.render_results(
+                result,
+                host_vars,
+                _templar=_templar,
+                _process_results=_process_results,
+                jinja2_native=jinja2_native,
+            )
+
+        return ret